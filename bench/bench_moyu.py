@@ -0,0 +1,278 @@
+'''
+摸鱼人日历插件离线基准测试
+
+不访问网络：用本地 aiohttp 服务模拟摸鱼日历 API（可配置延迟、错误率和图片大小），
+用假的 Context 代替 AstrBot 发送消息，在临时目录中运行 MyPlugin，测量：
+  - 图片获取吞吐量（每次都绕过缓存向上游请求）
+  - N 个发送目标的定时发送耗时
+  - 调度偏差（目标时间与实际触发时间之差）
+  - 每个订阅占用的内存
+
+结果以 JSON 输出，便于不同版本之间对比。需在安装了 AstrBot 的 Python 环境中运行：
+    python bench/bench_moyu.py --targets 1000 --output bench_output.json
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PLUGIN_DIR)
+
+import main  # noqa: E402
+
+
+class FakeContext:
+    '''代替 AstrBot 的 Context，只记录 send_message 的调用'''
+
+    def __init__(self, latency, failure_rate):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = 0
+        self.failed = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    def expect(self, count):
+        self.sent = 0
+        self.failed = 0
+        self.expected = count
+        self.done.clear()
+
+    async def send_message(self, session, message_chain):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.failed += 1
+            raise RuntimeError("模拟发送失败")
+        self.sent += 1
+        if self.sent >= self.expected:
+            self.done.set()
+        return True
+
+
+class FakeEvent:
+    '''代替 AstrMessageEvent，供调用 /set_time 等指令使用'''
+
+    def __init__(self, unified_msg_origin):
+        self.unified_msg_origin = unified_msg_origin
+
+    def plain_result(self, text):
+        return text
+
+
+async def start_stub_upstream(latency, error_rate, image_bytes):
+    '''启动模拟的摸鱼日历 API，返回 (runner, url, 请求计数)'''
+    image = os.urandom(image_bytes)
+    stats = {"requests": 0, "errors": 0}
+
+    async def handler(request):
+        stats["requests"] += 1
+        await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return web.Response(status=500, text="模拟上游错误")
+        return web.Response(body=image, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/moyu", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/moyu", stats
+
+
+def summarize(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+async def bench_fetch(plugin, count):
+    '''每次获取前清除当天缓存的再验证时间，使每次都向上游完整下载'''
+    plugin.cache_revalidate_seconds = 0
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        if not await plugin.get_moyu_image():
+            failures += 1
+    elapsed = time.perf_counter() - start
+    plugin.cache_revalidate_seconds = 3600
+    histogram = plugin.metrics.histogram("moyu_upstream_fetch_seconds", upstream=plugin.moyu_api_url)
+    return {
+        "fetches": count,
+        "failures": failures,
+        "seconds": elapsed,
+        "fetches_per_second": count / elapsed if elapsed else None,
+        "latency": summarize(list(histogram.recent)) if histogram else None,
+    }
+
+
+async def bench_fanout(plugin, context, targets, timeout):
+    tz = plugin.user_custom_timezone
+    umos = [f"bench:GroupMessage:{i}" for i in range(targets)]
+    # 先预热当天的图片缓存，只测量发送部分
+    await plugin.get_moyu_image()
+    context.expect(targets)
+    start = time.perf_counter()
+    await plugin.send_scheduled([(umo, tz) for umo in umos], datetime.datetime.now(tz), due=time.time())
+    try:
+        await asyncio.wait_for(context.done.wait(), timeout=timeout)
+        completed = True
+    except asyncio.TimeoutError:
+        completed = False
+    elapsed = time.perf_counter() - start
+    return {
+        "targets": targets,
+        "completed": completed,
+        "seconds": elapsed,
+        "sends_per_second": context.sent / elapsed if elapsed else None,
+        "sent": context.sent,
+        "send_failures": context.failed,
+        "dead_letters": len(plugin.dead_letters),
+    }
+
+
+async def bench_drift(plugin, context, rounds, lead):
+    '''让调度器在 lead 秒后触发一个批次，重复 rounds 次，统计实际触发时间的偏差'''
+    tz = plugin.user_custom_timezone
+    real_next_target_time = plugin.get_next_target_time
+    drifts = []
+    try:
+        for _ in range(rounds):
+            # 每轮使用新的订阅，不带上一轮保存的 next_due/last_sent 快照
+            plugin.subscriptions = {"bench:GroupMessage:drift": {"time": "09:00"}}
+            target = datetime.datetime.now(tz) + datetime.timedelta(seconds=lead)
+            plugin.get_next_target_time = lambda now, custom_time, target=target: target if now < target else None
+            histogram = plugin.metrics.histogram("moyu_scheduler_drift_seconds")
+            before = histogram.count if histogram else 0
+            context.expect(1)
+            plugin.reschedule()
+            await asyncio.wait_for(context.done.wait(), timeout=lead + 30)
+            histogram = plugin.metrics.histogram("moyu_scheduler_drift_seconds")
+            if histogram and histogram.count > before:
+                drifts.append(histogram.recent[-1])
+    finally:
+        plugin.get_next_target_time = real_next_target_time
+        plugin.subscriptions = {}
+        plugin.reschedule()
+    return {"rounds": rounds, "drift_seconds": summarize(drifts)}
+
+
+async def bench_memory(plugin, count):
+    '''通过 /set_time 添加 count 个订阅并重建调度，统计新增的内存'''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        async for _ in plugin.set_time(FakeEvent(f"bench:GroupMessage:mem{i}"), f"{9 + i % 3:02d}:{i % 60:02d}"):
+            pass
+    plugin._rebuild_schedule()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    plugin.subscriptions = {}
+    plugin.reschedule()
+    return {
+        "subscriptions": count,
+        "bytes": allocated,
+        "bytes_per_subscription": allocated / count if count else None,
+        "buckets": len(plugin._buckets),
+    }
+
+
+def plugin_version():
+    with open(os.path.join(PLUGIN_DIR, "metadata.yaml"), "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("version:"):
+                return line.split(":", 1)[1].split("#", 1)[0].strip()
+    return None
+
+
+async def run(args):
+    random.seed(args.seed)
+    runner, url, upstream_stats = await start_stub_upstream(
+        args.upstream_latency_ms / 1000, args.upstream_error_rate, args.image_kb * 1024)
+    data_dir = tempfile.mkdtemp(prefix="moyu-bench-")
+    # 插件的缓存、订阅和死信文件都写入临时目录
+    main.PLUGIN_DIR = data_dir
+    context = FakeContext(args.send_latency_ms / 1000, args.send_failure_rate)
+    config = {
+        "moyu_api_url": url,
+        "send_concurrency": args.concurrency,
+        "platform_rate_limit": args.platform_rate,
+        "target_rate_limit": 0,
+        "send_retry_base": 0.05,
+        "prefetch_minutes": 0,
+    }
+    plugin = main.MyPlugin(context, config)
+    try:
+        results = {
+            "fetch": await bench_fetch(plugin, args.fetches),
+            "fanout": await bench_fanout(plugin, context, args.targets, args.timeout),
+            "drift": await bench_drift(plugin, context, args.drift_rounds, args.drift_lead),
+            "memory": await bench_memory(plugin, args.memory_subscriptions),
+        }
+    finally:
+        await plugin.terminate()
+        await runner.cleanup()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        "plugin_version": plugin_version(),
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "params": vars(args),
+        "upstream": upstream_stats,
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="摸鱼人日历插件离线基准测试")
+    parser.add_argument("--targets", type=int, default=1000, help="定时发送的目标数量")
+    parser.add_argument("--concurrency", type=int, default=10, help="发送并发数（send_concurrency）")
+    parser.add_argument("--platform-rate", type=float, default=0, help="每个平台的发送速率，0 为不限速")
+    parser.add_argument("--fetches", type=int, default=50, help="图片获取次数")
+    parser.add_argument("--image-kb", type=int, default=200, help="模拟图片大小（KB）")
+    parser.add_argument("--upstream-latency-ms", type=float, default=50, help="模拟上游延迟（毫秒）")
+    parser.add_argument("--upstream-error-rate", type=float, default=0, help="模拟上游错误率")
+    parser.add_argument("--send-latency-ms", type=float, default=5, help="模拟 send_message 延迟（毫秒）")
+    parser.add_argument("--send-failure-rate", type=float, default=0, help="模拟 send_message 失败率")
+    parser.add_argument("--drift-rounds", type=int, default=5, help="调度偏差测量次数")
+    parser.add_argument("--drift-lead", type=float, default=0.5, help="每次调度距离触发的秒数")
+    parser.add_argument("--memory-subscriptions", type=int, default=10000, help="内存测量的订阅数量")
+    parser.add_argument("--timeout", type=float, default=300, help="定时发送等待完成的最长时间（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--output", help="结果写入的 JSON 文件，不指定时输出到标准输出")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    cli()
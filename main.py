@@ -4,93 +4,917 @@ from astrbot.api import logger
 from astrbot.api.message_components import *
 import json
 import asyncio
+import collections
+import concurrent.futures
 import datetime 
-import aiohttp
+import heapq
+import itertools
 import os
+import random
+import sqlite3
+import time
+import traceback
 import tempfile
-from zoneinfo import ZoneInfo  # 导入 ZoneInfo 用于处理时区
-import chinese_calendar as calendar  # 导入 chinese_calendar 库
+import uuid
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError  # 导入 ZoneInfo 用于处理时区
+
+# 插件所在目录，schedule.json 与图片缓存目录都存放在这里
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MOYU_API_URL = "https://api.52vmy.cn/api/wl/moyu"
+
+
+def atomic_write_text(path, text):
+    '''先写入同目录下的临时文件并刷盘，再原子替换目标文件，写到一半崩溃也不会损坏原文件'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class JsonFileWriter:
+    '''
+    JSON 文件的延迟写入：在事件循环中保存时，合并 delay 秒内的多次修改，
+    在线程中原子写盘，不阻塞事件循环；没有运行中的事件循环时立即写入
+    '''
+
+    def __init__(self, path, delay=0.5, **dump_kwargs):
+        self.path = path
+        self.delay = delay
+        self.dump_kwargs = dump_kwargs
+        self._data = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def save(self, data):
+        self._data = data
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(json.dumps(self._data, **self.dump_kwargs))
+            self._data = None
+            return
+        if self._task is None:
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        '''立即写入尚未保存的修改'''
+        if self._data is None:
+            return
+        # 在事件循环中序列化得到快照，之后的修改不会影响本次写入
+        text = json.dumps(self._data, **self.dump_kwargs)
+        self._data = None
+        async with self._lock:
+            await asyncio.to_thread(self._write, text)
+
+    def _write(self, text):
+        try:
+            atomic_write_text(self.path, text)
+        except Exception as e:
+            logger.error(f"保存文件 {self.path} 失败: {e}")
+
+
+class JsonScheduleStore:
+    '''schedule.json 订阅存储，每次保存写入完整文件'''
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = JsonFileWriter(path, ensure_ascii=False)
+        # 读取到旧版本格式时置为 True，由调用方保存为新格式
+        self.migrated = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        subscriptions = data.get('subscriptions')
+        if subscriptions is None:
+            # 兼容旧版本只保存单个发送目标的格式
+            subscriptions = {}
+            if data.get('user_custom_time') and data.get('message_target'):
+                subscriptions[data['message_target']] = {'time': data['user_custom_time']}
+            self.migrated = True
+        return subscriptions
+
+    def save(self, subscriptions, keys):
+        self._writer.save({'subscriptions': subscriptions})
+
+    async def flush(self):
+        await self._writer.flush()
+
+
+class SqliteScheduleStore:
+    '''SQLite 订阅存储，订阅数量很多时每次只写入发生变化的订阅'''
+
+    def __init__(self, path, delay=0.5):
+        self.path = path
+        self.delay = delay
+        self.migrated = False
+        self._pending = {}
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS subscriptions (origin TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        return conn
+
+    def load(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT origin, data FROM subscriptions").fetchall()
+        finally:
+            conn.close()
+        return {origin: json.loads(data) for origin, data in rows}
+
+    def save(self, subscriptions, keys):
+        for key in keys:
+            sub = subscriptions.get(key)
+            self._pending[key] = json.dumps(sub, ensure_ascii=False) if sub is not None else None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._apply(self._take_pending())
+            return
+        if self._task is None:
+            self._task = loop.create_task(self._flush_later())
+
+    def _take_pending(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending = self._take_pending()
+        async with self._lock:
+            await asyncio.to_thread(self._apply, pending)
+
+    def _apply(self, pending):
+        '''在一个事务中写入变化的订阅，返回是否写入成功'''
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO subscriptions (origin, data) VALUES (?, ?)",
+                        [(key, data) for key, data in pending.items() if data is not None],
+                    )
+                    conn.executemany(
+                        "DELETE FROM subscriptions WHERE origin = ?",
+                        [(key,) for key, data in pending.items() if data is None],
+                    )
+            finally:
+                conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"保存定时任务信息到 {self.path} 失败: {e}")
+            return False
+
+
+def encode_image_variant(src_path, dst_path, max_width, quality):
+    '''
+    缩放并重新压缩图片，在线程池或进程池中执行。
+    max_width 为 0 时不缩放；结果先写临时文件再原子替换 dst_path
+    '''
+    from PIL import Image as PILImage  # Pillow 为可选依赖，仅在配置了图片规格时使用
+
+    with PILImage.open(src_path) as img:
+        img = img.convert('RGB')
+        if max_width and img.width > max_width:
+            img = img.resize((max_width, round(img.height * max_width / img.width)), PILImage.LANCZOS)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path), suffix=".part")
+        os.close(fd)
+        try:
+            img.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class Histogram:
+    '''累计直方图，另外保留最近的样本用于计算分位数'''
+
+    def __init__(self, buckets, window=500):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Metrics:
+    '''插件运行指标：计数器和直方图，可按标签区分，支持输出 Prometheus 文本格式'''
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    DRIFT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def counter(self, name, **labels):
+        '''返回计数器的值，未指定标签时汇总所有标签'''
+        if labels:
+            return self.counters.get(self._key(name, labels), 0)
+        return sum(value for (n, _), value in self.counters.items() if n == name)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(self._key(name, labels))
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        parts = []
+        for k, v in items:
+            v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render_prometheus(self, extra_counters=(), gauges=()):
+        '''输出 Prometheus 文本格式，extra_counters 和 gauges 为额外的 (名称, 标签字典, 值)'''
+        lines = []
+        typed = set()
+        counters = [(name, tuple(sorted(labels.items())), value, "counter") for name, labels, value in extra_counters]
+        counters += [(name, labels, value, "counter") for (name, labels), value in sorted(self.counters.items())]
+        counters += [(name, tuple(sorted(labels.items())), value, "gauge") for name, labels, value in gauges]
+        for name, labels, value, kind in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class UpstreamError(Exception):
+    '''上游 API 返回了无法使用的响应'''
+
+
+class Upstream:
+    '''
+    单个摸鱼日历 API 的延迟统计与熔断状态。
+    连续失败达到阈值后熔断一段时间，期满后放行请求试探，成功即恢复。
+    '''
+
+    def __init__(self, url, failure_threshold=3, open_seconds=60, window=50):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def available(self, now=None):
+        return (now or time.time()) >= self.open_until
+
+    def p95(self):
+        '''最近请求耗时的 p95，样本不足时返回 None'''
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def error_rate(self):
+        return self.errors / self.requests if self.requests else 0.0
+
+    def record_success(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.time() + self.open_seconds
+            logger.error(f"摸鱼日历API {self.url} 连续失败 {self.consecutive_failures} 次，熔断 {self.open_seconds} 秒")
+
+
+class TokenBucket:
+    '''
+    令牌桶限速器：以 rate 个/秒的速度补充令牌，最多积攒 capacity 个。
+    令牌不足时预约未来的令牌并等待，先到先得，无需加锁
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        '''取走一个令牌，返回需要等待的秒数'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self):
+        '''令牌已补满，说明近期没有使用'''
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class WorkdayCalendar:
+    '''
+    按年预计算的工作日索引，跨年时按需扩展。
+    支持通过覆盖文件指定公司自定义的节假日和调休工作日，格式为
+    {"holidays": ["2025-10-09"], "workdays": ["2025-09-28"]}
+    '''
+
+    def __init__(self, overrides_file=None):
+        # 年份 -> 当年每一天是否为工作日（下标为当年第几天，从 0 开始）
+        self._years = {}
+        self.holidays = set()
+        self.workdays = set()
+        if overrides_file:
+            self.load_overrides(overrides_file)
+
+    def load_overrides(self, overrides_file):
+        '''加载自定义节假日/调休覆盖文件，已计算的索引会被清空重建'''
+        if not os.path.exists(overrides_file):
+            return
+        try:
+            with open(overrides_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.holidays = {datetime.date.fromisoformat(d) for d in data.get('holidays', [])}
+            self.workdays = {datetime.date.fromisoformat(d) for d in data.get('workdays', [])}
+            self._years.clear()
+            logger.info(f"已加载工作日覆盖文件: {len(self.holidays)} 个节假日，{len(self.workdays)} 个调休工作日")
+        except Exception as e:
+            logger.error(f"加载工作日覆盖文件失败: {e}")
+
+    def _year(self, year):
+        index = self._years.get(year)
+        if index is not None:
+            return index
+        # 首次需要计算工作日时才导入 chinese_calendar，加快插件启动
+        import chinese_calendar as calendar
+        first_day = datetime.date(year, 1, 1)
+        days = (datetime.date(year + 1, 1, 1) - first_day).days
+        index = bytearray(days)
+        for offset in range(days):
+            day = first_day + datetime.timedelta(days=offset)
+            if day in self.workdays:
+                index[offset] = 1
+            elif day in self.holidays:
+                index[offset] = 0
+            else:
+                try:
+                    index[offset] = calendar.is_workday(day)
+                except NotImplementedError:
+                    # chinese_calendar 尚未收录该年份的节假日安排，按周一至周五计算
+                    index[offset] = day.weekday() < 5
+        self._years[year] = index
+        return index
+
+    def is_workday(self, day: datetime.date):
+        return bool(self._year(day.year)[day.timetuple().tm_yday - 1])
+
+    def next_workday(self, day: datetime.date):
+        '''返回 day 当天或之后的第一个工作日，两年内找不到则返回 None'''
+        for _ in range(2):
+            index = self._year(day.year)
+            offset = index.find(1, day.timetuple().tm_yday - 1)
+            if offset != -1:
+                return datetime.date(day.year, 1, 1) + datetime.timedelta(days=offset)
+            day = datetime.date(day.year + 1, 1, 1)
+        return None
+
+    def next_workday_at(self, time: str, tz, now=None):
+        '''
+        计算下一个工作日的发送时刻（不早于 now）。
+        time 为 HH:MM 字符串，tz 为时区，返回带时区的 datetime，找不到工作日时返回 None
+        '''
+        now = now or datetime.datetime.now(tz)
+        now = now.astimezone(tz)
+        hour, minute = map(int, time.split(':'))
+        day = now.date()
+        if now > datetime.datetime(day.year, day.month, day.day, hour, minute, tzinfo=tz):
+            day += datetime.timedelta(days=1)
+        day = self.next_workday(day)
+        if day is None:
+            return None
+        return datetime.datetime(day.year, day.month, day.day, hour, minute, tzinfo=tz)
 
 @register("moyuren", "quirrel", "一个简单的摸鱼人日历插件", "1.3.7")
 class MyPlugin(Star):
     def __init__(self, context: Context, config: dict):
         super().__init__(context)
         self.enabled = config.get("enabled", True)  # 从配置文件读取摸鱼日历定时任务启用状态
-        self.temp_dir = tempfile.mkdtemp()  # 创建临时目录
         self.config = config
-        logger.info(f"插件配置信息: {self.config}")
-        self.moyu_api_url = config.get("moyu_api_url") or "https://api.52vmy.cn/api/wl/moyu"
-        logger.info(f"当前使用的摸鱼日历API URL: {self.moyu_api_url}")
+        # 支持多个上游 API，兼容旧的单个 moyu_api_url 配置
+        urls = list(config.get("moyu_api_urls") or [])
+        if config.get("moyu_api_url"):
+            urls.append(config["moyu_api_url"])
+        urls = list(dict.fromkeys(url.strip() for url in urls if url and url.strip())) or [DEFAULT_MOYU_API_URL]
+        self.moyu_api_url = urls[0]
+        self.upstreams = [Upstream(url) for url in urls]
+        # 上游延迟样本不足时，等待多久后发出对冲请求
+        self.hedge_delay = float(config.get("hedge_delay") or 2)
+        logger.info(f"当前使用的摸鱼日历API URL: {urls}")
         self.default_timezone = config.get("default_timezone")
         try:
             self.user_custom_timezone = ZoneInfo(self.default_timezone)
         except Exception:
             self.user_custom_timezone = ZoneInfo('Asia/Shanghai')
-        self.user_custom_time = None
-        self.message_target = None
-        # 获取当前脚本所在目录
-        plugin_dir = os.path.dirname(os.path.abspath(__file__))
-        # 将 schedule.json 存储在插件目录
-        self.schedule_file = os.path.join(plugin_dir, 'schedule.json')
+        # 订阅列表：unified_msg_origin -> {"time": "HH:MM", "timezone": "Asia/Shanghai"}，
+        # 每个会话可单独设置发送时间和时区，未设置时区时使用默认时区
+        self.subscriptions = {}
+        # 定时发送时同时向多少个会话并发发送
+        self.send_concurrency = max(1, int(config.get("send_concurrency") or 10))
+        # 工作日索引，首次计算目标时间时按年生成，跨年时按需扩展
+        override_file = config.get("workday_override_file") or 'workday_overrides.json'
+        self.workday_calendar = WorkdayCalendar(os.path.join(PLUGIN_DIR, override_file))
+        # 按日期缓存摸鱼图片，同一天内重复发送不再重复下载
+        self.cache_dir = os.path.join(PLUGIN_DIR, 'cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_revalidate_seconds = int(config.get("image_cache_revalidate") or 3600)
+        self.cache_max_days = int(config.get("image_cache_max_days") or 7)
+        self.cache_max_bytes = int(float(config.get("image_cache_max_mb") or 50) * 1024 * 1024)
+        # 缓存命中统计：hit 为未下载图片内容直接使用缓存（含 304 再验证和合并到进行中的请求），miss 为重新下载
+        self.cache_stats = {"hit": 0, "miss": 0, "revalidated": 0, "stale": 0, "coalesced": 0}
+        self._image_inflight = {}
+        # 运行指标，可通过 /moyu_stats 查看，或定期写入 Prometheus 文本格式文件
+        self.metrics = Metrics()
+        self.target_failures = collections.Counter()
+        prometheus_file = config.get("prometheus_file")
+        self.prometheus_file = os.path.join(PLUGIN_DIR, prometheus_file) if prometheus_file else None
+        self.prometheus_interval = max(5, float(config.get("prometheus_interval") or 60))
+        # 按平台生成缩放/重新压缩的图片变体，按天缓存，编码在线程池或进程池中执行
+        self.image_profiles = self._parse_image_profiles(config.get("image_profiles") or [])
+        self.transcode_workers = max(1, int(config.get("transcode_workers") or 2))
+        self.transcode_in_process = bool(config.get("transcode_in_process", False))
+        self._transcode_executor = None
+        self._variant_inflight = {}
+        # /execute_now 按会话冷却，0 为不限制
+        self.execute_now_cooldown = float(config.get("execute_now_cooldown") or 0)
+        self._execute_now_last = {}
+        # 插件生命周期内共享的 HTTP 会话，复用连接并设置超时，首次请求时创建
+        self._session = None
+        self.http_connect_timeout = float(config.get("http_connect_timeout") or 5)
+        self.http_read_timeout = float(config.get("http_read_timeout") or 15)
+        self.http_total_timeout = float(config.get("http_total_timeout") or 30)
+        self.image_max_bytes = int(float(config.get("image_max_mb") or 10) * 1024 * 1024)
+        # 定时任务调度：最小堆按到期时间排序，日程变化时通过事件立即唤醒调度协程
+        self.next_target_time = None
+        self._schedule_heap = []
+        self._schedule_seq = itertools.count()
+        self._schedule_changed = asyncio.Event()
+        # 发送批次：同一绝对时刻到期的 (发送时间, 时区) 归为一个批次，共用一次唤醒和一次图片获取
+        self._buckets = {}
+        self._groups = {}
+        # 重启后在该时间窗口内补发错过的定时发送，根据每个会话的 last_sent 避免重复发送
+        self.catch_up_seconds = float(config.get("catch_up_minutes", 30)) * 60
+        # 补发批次：到期时间 -> 需要补发的会话，只在启动后第一次重建调度时计算
+        self._catch_up = {}
+        self._first_rebuild = True
+        # 在目标时间前提前预取图片，发送时只需直接发送
+        self.prefetch_seconds = float(config.get("prefetch_minutes") if config.get("prefetch_minutes") is not None else 5) * 60
+        self.prefetch_retry_interval = 30
+        self._background_tasks = set()
+        # 发送队列：失败的消息按指数退避重新入队，不阻塞其他目标，最终失败的进入死信记录
+        self._delivery_queue = asyncio.Queue()
+        self._delivery_workers = []
+        # 正在发送和等待重试的消息，插件卸载时写入死信记录
+        self._delivering = {}
+        self._retry_jobs = {}
+        self.send_max_retries = max(1, int(config.get("send_max_retries") or 5))
+        self.send_retry_base = float(config.get("send_retry_base") or 5)
+        self.send_retry_max = 300
+        self.dead_letter_file = os.path.join(PLUGIN_DIR, 'dead_letters.json')
+        self.dead_letter_limit = 200
+        self.dead_letters = self._load_dead_letters()
+        self._dead_letter_writer = JsonFileWriter(self.dead_letter_file, ensure_ascii=False)
+        # 按平台和按会话的令牌桶限速，避免同一时刻集中发送触发平台风控
+        self.platform_rate = float(config.get("platform_rate_limit", 5))
+        self.platform_burst = max(1, int(config.get("platform_burst") or 10))
+        self.platform_rate_overrides = self._parse_rate_limits(config.get("platform_rate_limits") or [])
+        self.target_rate = float(config.get("target_rate_limit", 0.5))
+        self.target_burst = 3
+        self._platform_buckets = {}
+        self._target_buckets = {}
+        # 将 schedule.json 存储在插件目录，订阅很多时可改用 SQLite 存储
+        self.schedule_file = os.path.join(PLUGIN_DIR, 'schedule.json')
+        if config.get("storage_backend") == "sqlite":
+            self.schedule_store = SqliteScheduleStore(os.path.join(PLUGIN_DIR, 'schedule.db'))
+        else:
+            self.schedule_store = JsonScheduleStore(self.schedule_file)
+        self._config_writer = None
         self.load_schedule()
-        asyncio.get_event_loop().create_task(self.scheduled_task()) 
+        self._scheduler_task = asyncio.create_task(self.scheduled_task())
+        self._metrics_task = asyncio.create_task(self.export_metrics()) if self.prometheus_file else None
         
     def load_schedule(self):
-        if not self.enabled:
-            logger.info("定时任务已禁用，不加载定时任务信息。")
-            return
-        '''加载定时任务信息'''
-        if os.path.exists(self.schedule_file):
+        '''加载定时任务信息，旧版本格式或改用 SQLite 后的 schedule.json 会自动迁移'''
+        try:
+            self.subscriptions = self.schedule_store.load()
+            if isinstance(self.schedule_store, SqliteScheduleStore) and not self.subscriptions \
+                    and os.path.exists(self.schedule_file):
+                self.subscriptions = JsonScheduleStore(self.schedule_file).load()
+                # 先同步写入数据库，成功后才重命名 schedule.json，中途崩溃也不会丢失订阅
+                if self.schedule_store._apply({
+                    umo: json.dumps(sub, ensure_ascii=False) for umo, sub in self.subscriptions.items()
+                }):
+                    os.replace(self.schedule_file, self.schedule_file + '.migrated')
+                    logger.info(f"已将 {self.schedule_file} 迁移到 SQLite 存储")
+            if self.schedule_store.migrated:
+                self.save_schedule()
+            logger.info(f"读取定时任务，共 {len(self.subscriptions)} 个订阅")
+        except Exception as e:
+            logger.error(f"加载定时任务信息失败: {e}")
+
+    def save_schedule(self, keys=None):
+        '''保存订阅信息，keys 为发生变化的订阅，未指定时保存全部'''
+        self.schedule_store.save(self.subscriptions, list(self.subscriptions) if keys is None else keys)
+
+    def _cache_paths(self, day: datetime.date):
+        '''返回指定日期的缓存图片路径和元数据路径'''
+        name = f"moyu_{day.isoformat()}"
+        return os.path.join(self.cache_dir, f"{name}.jpg"), os.path.join(self.cache_dir, f"{name}.json")
+
+    def _load_cache_meta(self, meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    async def _save_cache_meta(self, meta_path, meta):
+        try:
+            await asyncio.to_thread(atomic_write_text, meta_path, json.dumps(meta))
+        except Exception as e:
+            logger.error(f"保存图片缓存信息失败: {e}")
+
+    def _evict_cache(self, today: datetime.date):
+        '''按保留天数和总大小清理旧的缓存图片及其变体，当天的图片不会被清理'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith("moyu_"):
+                continue
             try:
-                with open(self.schedule_file, 'r') as f:
-                    data = json.load(f)
-                    self.user_custom_time = data.get('user_custom_time')
-                    self.message_target = data.get('message_target')
+                day = datetime.date.fromisoformat(name[5:15])
+            except ValueError:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            entries.append((day, path, os.path.getsize(path)))
+        # 从旧到新排序，优先清理最旧的日期
+        entries.sort()
+        total_size = sum(size for _, _, size in entries)
+        evicted_days = set()
+        for day, path, size in entries:
+            if day >= today:
+                break
+            if (today - day).days < self.cache_max_days and total_size <= self.cache_max_bytes:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            evicted_days.add(day)
+        for day in sorted(evicted_days):
+            logger.info(f"已清理过期的摸鱼图片缓存: {day}")
 
-                if self.user_custom_time:
-                    now = datetime.datetime.now(self.user_custom_timezone)
-                    target_hour, target_minute = map(int, self.user_custom_time.split(':'))
-                    target_time = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-                    if now > target_time:
-                        target_time = target_time + datetime.timedelta(days=1)
+    def get_cache_stats(self):
+        '''返回图片缓存的命中统计'''
+        total = self.cache_stats["hit"] + self.cache_stats["miss"]
+        hit_rate = self.cache_stats["hit"] / total if total else 0.0
+        return {**self.cache_stats, "hit_rate": hit_rate}
 
-                    time_until_target = (target_time - now).total_seconds()
-                    logger.info(f"读取定时任务，距离下次发送摸鱼图片还剩 {int(time_until_target)} 秒")
+    def _get_session(self):
+        '''获取共享的 aiohttp 会话，带连接池、DNS 缓存和长连接'''
+        if self._session is None or self._session.closed:
+            import aiohttp
 
-            except Exception as e:
-                logger.error(f"加载定时任务信息失败: {e}")
+            connector = aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+            # total 限制单次请求从连接到读完响应的总时长，防止上游逐字节慢速返回时一直占用发送
+            timeout = aiohttp.ClientTimeout(
+                total=self.http_total_timeout,
+                connect=self.http_connect_timeout,
+                sock_read=self.http_read_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def _download_to(self, res, image_path):
+        '''分块读取响应并写入缓存，超过大小上限时放弃，返回写入的字节数'''
+        if res.content_length and res.content_length > self.image_max_bytes:
+            raise ValueError(f"图片大小 {res.content_length} 字节超过上限 {self.image_max_bytes} 字节")
+        # 先写入临时文件再替换，避免发送时读到写了一半的图片
+        fd, part_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in res.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.image_max_bytes:
+                        raise ValueError(f"图片大小超过上限 {self.image_max_bytes} 字节")
+                    f.write(chunk)
+            os.replace(part_path, image_path)
+        except BaseException:
+            os.remove(part_path)
+            raise
+        return size
+
+    def _upstream_order(self):
+        '''按健康状况和延迟排序上游：未熔断的在前，延迟低的优先，样本不足的按对冲等待时间估计延迟'''
+        now = time.time()
+        healthy = [u for u in self.upstreams if u.available(now)]
+        broken = [u for u in self.upstreams if not u.available(now)]
+        healthy.sort(key=lambda u: (u.p95() or self.hedge_delay) * (1 + u.error_rate()))
+        broken.sort(key=lambda u: u.open_until)
+        # 全部熔断时仍按恢复时间依次尝试，避免完全无法获取
+        return healthy + broken
+
+    def _hedge_delay_for(self, upstream):
+        p95 = upstream.p95()
+        if p95 is None:
+            return self.hedge_delay
+        return min(max(p95, 0.2), self.http_read_timeout)
 
-    def save_schedule(self):
-        data = {
-            'user_custom_time': self.user_custom_time,
-            'message_target': self.message_target
-        }
+    async def _fetch_from(self, upstream, meta, image_path):
+        '''
+        从单个上游获取图片。缓存来自同一上游时带上 ETag/Last-Modified 做条件请求。
+        返回新的缓存元数据，304 时返回 None
+        '''
+        headers = {}
+        if meta and meta.get("source") == upstream.url:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        deadline = self._hedge_delay_for(upstream)
+        start = time.monotonic()
         try:
-            with open(self.schedule_file, 'w') as f:
-                json.dump(data, f)
+            async with self._get_session().get(upstream.url, headers=headers) as res:
+                if res.status == 304 and headers:
+                    self._record_fetch(upstream, time.monotonic() - start, "not_modified")
+                    return None
+                if res.status != 200:
+                    error_text = await res.text()
+                    raise UpstreamError(f"API请求失败: {res.status}, 详细原因: {error_text[:200]}")
+                size = await self._download_to(res, image_path)
+                self._record_fetch(upstream, time.monotonic() - start, "ok")
+                return {
+                    "source": upstream.url,
+                    "etag": res.headers.get("ETag"),
+                    "last_modified": res.headers.get("Last-Modified"),
+                    "checked_at": time.time(),
+                    "size": size,
+                }
+        except asyncio.CancelledError:
+            # 被更快的对冲请求取代时，已等待的时间只是延迟的下限，不计入延迟样本；
+            # 超过对冲等待时间仍未响应的计为一次超时失败，一直不响应的上游也会熔断
+            if time.monotonic() - start >= deadline:
+                upstream.record_failure()
+                self.metrics.inc("moyu_upstream_errors_total", upstream=upstream.url)
+            raise
         except Exception as e:
-            logger.error(f"保存定时任务信息失败: {e}")
+            upstream.record_failure()
+            self.metrics.inc("moyu_upstream_errors_total", upstream=upstream.url)
+            import aiohttp
 
-    async def get_moyu_image(self):
-        '''获取摸鱼人日历图片'''
+            if isinstance(e, aiohttp.InvalidURL):
+                logger.error(f"无效的URL: {upstream.url}, 错误信息: {str(e)}")
+            else:
+                logger.error(f"从 {upstream.url} 获取摸鱼图片时出错: {e.__class__.__name__}: {str(e)}")
+            raise
+
+    def _record_fetch(self, upstream, latency, result):
+        upstream.record_success(latency)
+        self.metrics.observe("moyu_upstream_fetch_seconds", latency, upstream=upstream.url)
+        self.metrics.inc("moyu_upstream_requests_total", upstream=upstream.url, result=result)
+
+    async def _fetch_hedged(self, meta, image_path):
+        '''
+        按优先级向上游发起请求：首选上游超过其 p95 延迟仍未响应时，向下一个上游发出对冲请求，
+        失败时立即切换到下一个上游，任意一个成功即取消其余请求
+        '''
+        order = self._upstream_order()
+        pending = set()
+        next_index = 0
+        last_error = None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.moyu_api_url) as res:
-                    if res.status != 200:
-                        error_text = await res.text()
-                        logger.error(f"API请求失败: {res.status}, 详细原因: {error_text}")
-                        return None
-                    # 保存图片到临时文件
-                    image_data = await res.read()
-                    temp_path = os.path.join(self.temp_dir, 'moyu.jpg')
-                    with open(temp_path, 'wb') as f:
-                        f.write(image_data)
-                    return temp_path
-        except aiohttp.InvalidURL as e:
-            logger.error(f"无效的URL: {self.config['moyu_api_url']}, 错误信息: {str(e)}")
+            while True:
+                if not pending:
+                    if next_index >= len(order):
+                        raise last_error or UpstreamError("没有可用的摸鱼日历API")
+                    pending.add(asyncio.create_task(self._fetch_from(order[next_index], meta, image_path)))
+                    next_index += 1
+                hedge_delay = self._hedge_delay_for(order[next_index - 1]) if next_index < len(order) else None
+                done, pending = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超过对冲等待时间仍未响应，向下一个上游发出对冲请求
+                    logger.info(f"{order[next_index - 1].url} 响应较慢，向 {order[next_index].url} 发出对冲请求")
+                    pending.add(asyncio.create_task(self._fetch_from(order[next_index], meta, image_path)))
+                    next_index += 1
+                    continue
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                last_error = next(iter(done)).exception()
+                if pending and next_index < len(order):
+                    # 有请求失败时立即切换到下一个上游，不必等待对冲时间
+                    pending.add(asyncio.create_task(self._fetch_from(order[next_index], meta, image_path)))
+                    next_index += 1
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _parse_image_profiles(self, items):
+        '''解析 "平台名=最大宽度:质量" 格式的图片规格配置，例如 aiocqhttp=1080:80，平台名为 default 时作用于其余平台'''
+        profiles = {}
+        for item in items:
+            try:
+                platform, profile = item.split('=', 1)
+                max_width, _, quality = profile.partition(':')
+                profiles[platform.strip()] = (int(max_width or 0), min(95, max(1, int(quality or 85))))
+            except ValueError:
+                logger.error(f"图片规格配置格式错误: {item}，应为 平台名=最大宽度:质量，例如 aiocqhttp=1080:80")
+        if profiles:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                logger.error("未安装 Pillow，无法生成图片变体，将发送原图。可使用 pip install pillow 安装")
+                return {}
+        return profiles
+
+    def _get_transcode_executor(self):
+        if self._transcode_executor is None:
+            if self.transcode_in_process:
+                self._transcode_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.transcode_workers)
+            else:
+                self._transcode_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.transcode_workers, thread_name_prefix="moyu-transcode")
+        return self._transcode_executor
+
+    async def get_image_variant(self, image_path, platform):
+        '''
+        返回适合指定平台的图片变体路径。变体与原图按天缓存，原图更新后重新生成；
+        未配置规格或生成失败时返回原图
+        '''
+        profile = self.image_profiles.get(platform) or self.image_profiles.get('default')
+        if profile is None:
+            return image_path
+        max_width, quality = profile
+        variant_path = f"{image_path[:-4]}_{max_width}w_q{quality}.jpg"
+        try:
+            if os.path.getmtime(variant_path) >= os.path.getmtime(image_path):
+                return variant_path
+        except OSError:
+            pass
+        # 同一变体同时只编码一次
+        future = self._variant_inflight.get(variant_path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._get_transcode_executor(), encode_image_variant, image_path, variant_path, max_width, quality)
+            self._variant_inflight[variant_path] = future
+            future.add_done_callback(lambda _: self._variant_inflight.pop(variant_path, None))
+        try:
+            await asyncio.shield(future)
+            return variant_path
         except Exception as e:
-            logger.error(f"获取摸鱼图片时出错: {e.__class__.__name__}: {str(e)}")
+            logger.error(f"生成图片变体 {variant_path} 失败，发送原图: {e.__class__.__name__}: {str(e)}")
+            return image_path
+
+    async def get_image_variants(self, image_path, platforms):
+        '''一次性为多个平台生成图片变体，返回 平台名 -> 图片路径'''
+        platforms = list(platforms)
+        paths = await asyncio.gather(*(self.get_image_variant(image_path, platform) for platform in platforms))
+        return dict(zip(platforms, paths))
+
+    def get_upstream_stats(self):
+        '''返回各上游的延迟、错误率和熔断状态'''
+        now = time.time()
+        return [{
+            "url": u.url,
+            "requests": u.requests,
+            "error_rate": u.error_rate(),
+            "p95": u.p95(),
+            "available": u.available(now),
+        } for u in self.upstreams]
+
+    async def get_moyu_image(self, fresh_until=None):
+        '''
+        获取摸鱼人日历图片，同一天内优先使用本地缓存。
+        fresh_until 为时间戳时，缓存在该时刻之前就需要再验证的也立即向上游再验证
+        '''
+        today = datetime.datetime.now(self.user_custom_timezone).date()
+        image_path, meta_path = self._cache_paths(today)
+        meta = self._load_cache_meta(meta_path) if os.path.exists(image_path) else None
+        deadline = max(time.time(), fresh_until or 0)
+        if meta and deadline - meta.get("checked_at", 0) < self.cache_revalidate_seconds:
+            self.cache_stats["hit"] += 1
+            return image_path
+        # 同一天的图片同时只发起一次请求，并发的调用方等待同一个结果
+        task = self._image_inflight.get(today)
+        if task is not None:
+            image_path = await asyncio.shield(task)
+            if image_path:
+                self.cache_stats["hit"] += 1
+                self.cache_stats["coalesced"] += 1
+            return image_path
+        task = asyncio.ensure_future(self._refresh_image(today, image_path, meta_path, meta))
+        self._image_inflight[today] = task
+        task.add_done_callback(lambda _: self._image_inflight.pop(today, None))
+        return await asyncio.shield(task)
+
+    async def _refresh_image(self, today, image_path, meta_path, meta):
+        '''向上游获取或再验证当天的图片'''
+        try:
+            new_meta = await self._fetch_hedged(meta, image_path)
+        except Exception:
+            return self._stale_image(image_path, meta)
+        if new_meta is None:
+            # 上游返回 304，缓存的图片仍然有效
+            meta["checked_at"] = time.time()
+            await self._save_cache_meta(meta_path, meta)
+            self.cache_stats["hit"] += 1
+            self.cache_stats["revalidated"] += 1
+            return image_path
+        await self._save_cache_meta(meta_path, new_meta)
+        self.cache_stats["miss"] += 1
+        self._evict_cache(today)
+        return image_path
+
+    def _stale_image(self, image_path, meta):
+        '''上游不可用时，若当天已有缓存则继续使用'''
+        if meta is None:
             return None
+        self.cache_stats["stale"] += 1
+        logger.info("摸鱼图片API不可用，使用当天已缓存的图片。")
+        return image_path
 
     def parse_time(self, time: str):
         try:
@@ -119,17 +943,12 @@ class MyPlugin(Star):
         if not parsed_time:
             yield event.plain_result("时间格式错误，请输入正确的格式，例如：09:00或0900")
             return
-        self.user_custom_time = parsed_time
-        # 保存消息发送目标
-        self.message_target = event.unified_msg_origin
-        yield event.plain_result(f"自定义时间已设置为: {self.user_custom_time}")
-        self.save_schedule()
-        self.load_schedule()
-        # 重置检查计数器
-        self.check_count = 0
-        # 重置 next_target_time，让 scheduled_task 重新计算目标时间
-        self.next_target_time = None  
-        self.task_executed = False
+        # 保存消息发送目标，每个会话各自一条订阅，保留已设置的时区
+        self.subscriptions[event.unified_msg_origin] = {**self.subscriptions.get(event.unified_msg_origin, {}), 'time': parsed_time}
+        yield event.plain_result(f"自定义时间已设置为: {parsed_time}")
+        self.save_schedule([event.unified_msg_origin])
+        # 唤醒 scheduled_task 重新计算目标时间
+        self.reschedule()
 
     def save_config(self):
         """
@@ -146,10 +965,11 @@ class MyPlugin(Star):
             if not os.path.exists(config_dir):
                 os.makedirs(config_dir)
             config_file = os.path.join(config_dir, 'astrbot_plugin_moyurenpro_config.json')
-            with open(config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, ensure_ascii=False, indent=4)
+            if self._config_writer is None:
+                self._config_writer = JsonFileWriter(config_file, ensure_ascii=False, indent=4)
+            self._config_writer.save(dict(self.config))
             # 添加日志记录保存目录
-            logger.info(f"配置文件已保存到: {config_file}")
+            logger.info(f"配置文件将保存到: {config_file}")
         except Exception as e:
             logger.error(f"保存配置文件时出错: {e}")
 
@@ -157,6 +977,22 @@ class MyPlugin(Star):
         """
         关闭定时任务并清理缓存
         """
+        # 先把尚未送达的消息写入死信记录，再取消发送协程，避免卸载时静默丢弃
+        self._dead_letter_pending_deliveries()
+        self._scheduler_task.cancel()
+        for task in list(self._background_tasks):
+            task.cancel()
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+        if self._transcode_executor is not None:
+            self._transcode_executor.shutdown(wait=False, cancel_futures=True)
+        # 写入尚未落盘的订阅、配置和死信记录
+        for writer in (self.schedule_store, self._config_writer, self._dead_letter_writer):
+            if writer is not None:
+                await writer.flush()
+        # 关闭共享的 HTTP 会话
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
         # 禁用定时任务
         #self.enabled = False
         #self.config["enabled"] = self.enabled
@@ -184,236 +1020,548 @@ class MyPlugin(Star):
         status = "启用" if self.enabled else "禁用"
         self.config["enabled"] = self.enabled
         self.save_config()  # 保存配置文件
-        self.save_schedule()  # 保存更新后的配置
         yield event.plain_result(f"摸鱼人日历已{status}")        
-        self.load_schedule()  # 载入初始化
+        self.reschedule()
 
     @filter.command("reset_time")
     async def reset_time(self, event: AstrMessageEvent):
-        '''重置发送摸鱼图片的时间'''
-        self.user_custom_time = None
-        self.message_target = None
-        self.save_schedule()
+        '''重置当前会话发送摸鱼图片的时间'''
+        self.subscriptions.pop(event.unified_msg_origin, None)
+        self.save_schedule([event.unified_msg_origin])
+        self.reschedule()
         yield event.plain_result("自定义时间已重置")
 
     @filter.command("execute_now")
     async def execute_now(self, event: AstrMessageEvent):
         '''立即发送！'''
+        if self.execute_now_cooldown > 0:
+            now = time.monotonic()
+            last = self._execute_now_last.get(event.unified_msg_origin)
+            if last is not None and now - last < self.execute_now_cooldown:
+                yield event.plain_result(f"操作过于频繁，请 {int(self.execute_now_cooldown - (now - last)) + 1} 秒后再试")
+                return
+            if len(self._execute_now_last) >= 10000:
+                self._execute_now_last = {k: v for k, v in self._execute_now_last.items() if now - v < self.execute_now_cooldown}
+            self._execute_now_last[event.unified_msg_origin] = now
         image_path = await self.get_moyu_image()
         if not image_path:
             yield event.plain_result("获取摸鱼图片失败，请稍后再试")
             return
-        now = datetime.datetime.now(self.user_custom_timezone)
-        current_time = now.strftime("%Y-%m-%d %H:%M")
-        chain = [
-            Plain("📅 摸鱼人日历"),
-            Plain(f"🎯 {current_time}"),
-            Image.fromFileSystem(image_path),  # 使用 fromFileSystem 方法
-            Plain("⏰ 摸鱼提醒：工作再累，一定不要忘记摸鱼哦 ~")
+        # 按当前会话设置的时区显示时间
+        now = datetime.datetime.now(self._timezone(self.subscriptions.get(event.unified_msg_origin, {}).get('timezone')))
+        image_path = await self.get_image_variant(image_path, event.unified_msg_origin.split(':', 1)[0])
+        # 通过发送队列发送，失败时自动退避重试
+        self.enqueue_delivery(event.unified_msg_origin, image_path, now.strftime("%Y-%m-%d %H:%M"))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("moyu_dead_letters")
+    async def show_dead_letters(self, event: AstrMessageEvent):
+        '''查看多次重试后仍发送失败的消息'''
+        if not self.dead_letters:
+            yield event.plain_result("没有发送失败的消息")
+            return
+        lines = [f"共 {len(self.dead_letters)} 条发送失败的消息（显示最近 20 条）:"]
+        for job in self.dead_letters[-20:]:
+            lines.append(f"[{job['id']}] {job['target']} {job['sent_time']} 重试 {job['attempts']} 次: {job['error']}")
+        lines.append("使用 /moyu_replay <编号> 重新发送，/moyu_replay all 全部重新发送")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("moyu_replay")
+    async def replay_dead_letters(self, event: AstrMessageEvent, job_id: str = "all"):
+        '''重新发送死信记录中的消息'''
+        if job_id == "all":
+            jobs, self.dead_letters = self.dead_letters, []
+        else:
+            jobs = [job for job in self.dead_letters if job['id'] == job_id]
+            self.dead_letters = [job for job in self.dead_letters if job['id'] != job_id]
+        if not jobs:
+            yield event.plain_result(f"未找到编号为 {job_id} 的消息")
+            return
+        self._save_dead_letters()
+        for job in jobs:
+            # 原图片已被清理时重新获取当天的图片
+            image_path = job['image_path'] if os.path.exists(job['image_path']) else await self.get_moyu_image()
+            if image_path:
+                self.enqueue_delivery(job['target'], image_path, job['sent_time'], job.get('due'))
+        yield event.plain_result(f"已重新加入发送队列 {len(jobs)} 条消息")
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("moyu_stats")
+    async def show_stats(self, event: AstrMessageEvent):
+        '''查看图片获取、缓存、发送和调度的运行统计'''
+        yield event.plain_result(self.format_stats())
+
+    def format_stats(self):
+        def seconds(histogram):
+            if histogram is None or not histogram.count:
+                return "暂无数据"
+            return (f"p50 {histogram.quantile(0.5):.3f} 秒，p95 {histogram.quantile(0.95):.3f} 秒，"
+                    f"最大 {histogram.max:.3f} 秒（共 {histogram.count} 次）")
+
+        cache = self.get_cache_stats()
+        lines = [
+            "📊 摸鱼日历运行统计",
+            f"图片缓存：命中 {cache['hit']} 次，未命中 {cache['miss']} 次，命中率 {cache['hit_rate']:.1%}，"
+            f"再验证 {cache['revalidated']} 次，合并请求 {cache['coalesced']} 次，使用旧缓存 {cache['stale']} 次",
+        ]
+        for upstream in self.upstreams:
+            status = "正常" if upstream.available() else "熔断中"
+            lines.append(f"上游 {upstream.url}（{status}）：请求 {upstream.requests} 次，错误率 {upstream.error_rate():.1%}，"
+                         f"耗时 {seconds(self.metrics.histogram('moyu_upstream_fetch_seconds', upstream=upstream.url))}")
+        lines.append(f"发送：成功 {self.metrics.counter('moyu_sends_total')} 次，失败 {self.metrics.counter('moyu_send_failures_total')} 次，"
+                     f"死信 {len(self.dead_letters)} 条，队列中 {self._delivery_queue.qsize()} 条")
+        send_histograms = [(key[1], h) for key, h in self.metrics.histograms.items() if key[0] == "moyu_send_seconds"]
+        for labels, histogram in sorted(send_histograms):
+            lines.append(f"  平台 {dict(labels)['platform']} 发送耗时：{seconds(histogram)}")
+        lines.append(f"定时送达延迟：{seconds(self.metrics.histogram('moyu_delivery_delay_seconds'))}")
+        lines.append(f"调度偏差：{seconds(self.metrics.histogram('moyu_scheduler_drift_seconds'))}")
+        lines.append(f"重启后补发：{self.metrics.counter('moyu_scheduler_catch_up_total')} 个发送目标")
+        if self.target_failures:
+            top = "，".join(f"{target} {count} 次" for target, count in self.target_failures.most_common(5))
+            lines.append(f"失败最多的会话：{top}")
+        lines.append(f"订阅 {len(self.subscriptions)} 个，下一次发送：{self.next_target_time or '无'}")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        '''输出 Prometheus 文本格式的指标'''
+        counters = [(f"moyu_cache_{name}_total", {}, value) for name, value in self.cache_stats.items()]
+        gauges = [
+            ("moyu_dead_letters", {}, len(self.dead_letters)),
+            ("moyu_subscriptions", {}, len(self.subscriptions)),
+            ("moyu_delivery_queue_size", {}, self._delivery_queue.qsize()),
         ]
-        # 发送失败重试
-        max_retries = 3
-        for retry in range(max_retries):
+        return self.metrics.render_prometheus(counters, gauges)
+
+    async def export_metrics(self):
+        '''定期将指标原子写入 Prometheus 文本格式文件，可配合 node_exporter 的 textfile 收集器使用'''
+        while True:
             try:
-                yield event.chain_result(chain)
-                logger.info("摸鱼图片发送成功。")
-                break
+                await asyncio.to_thread(atomic_write_text, self.prometheus_file, self.render_prometheus())
             except Exception as e:
-                if retry < max_retries - 1:
-                    logger.error(f"发送消息失败，第 {retry + 1} 次重试: {str(e)}")
-                    await asyncio.sleep(5)  # 等待 5 秒后重试
-                else:
-                    logger.error(f"发送消息失败，达到最大重试次数: {str(e)}")
-                    yield event.plain_result("发送消息失败，请稍后再试")
+                logger.error(f"写入指标文件 {self.prometheus_file} 失败: {e}")
+            await asyncio.sleep(self.prometheus_interval)
 
     @filter.command("set_timezone")
     async def set_timezone(self, event: AstrMessageEvent, timezone: str):
         """
-        设置发送摸鱼图片的时区
+        设置当前会话发送摸鱼图片的时区
         如 'Asia/Shanghai'
         """
         try:
-            self.user_custom_timezone = ZoneInfo(timezone)
-            self.config['default_timezone'] = timezone
-            yield event.plain_result(f"时区已设置为: {timezone}")
-            self.save_config()  # 添加保存配置的操作
-        except ZoneInfoNotFoundError:
+            ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError):
             yield event.plain_result("未知的时区，请输入有效的时区名称，例如：Asia/Shanghai")
+            return
+        sub = self.subscriptions.get(event.unified_msg_origin)
+        if sub is None:
+            yield event.plain_result("当前会话还没有设置发送时间，请先使用 /set_time 设置")
+            return
+        sub['timezone'] = timezone
+        self.save_schedule([event.unified_msg_origin])
+        self.reschedule()
+        yield event.plain_result(f"时区已设置为: {timezone}")
 
-    def get_next_target_time(self, now):
+    def _timezone(self, name):
+        '''订阅的时区，未设置或无效时使用默认时区'''
+        if not name:
+            return self.user_custom_timezone
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            return self.user_custom_timezone
+
+    def get_next_target_time(self, now, custom_time):
         """
         根据当前时间计算下一次发送摸鱼图片的目标时间。
 
-        当前时间（datetime.datetime 对象）
+        当前时间（datetime.datetime 对象），发送时间（HH:MM 字符串）
         下一次发送摸鱼图片的目标时间（datetime.datetime 对象）
         """
         if not self.enabled:
             return None
-        # 从用户自定义时间中提取小时和分钟
-        target_hour, target_minute = map(int, self.user_custom_time.split(':'))
-        # 创建目标时间对象，将当前时间的小时和分钟替换为目标小时和分钟
-        target_time = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-        # 如果当前时间已经超过目标时间，将目标时间设置为明天的同一时间
-        if now > target_time:
-            target_time = target_time + datetime.timedelta(days=1)
-        return target_time
+        # 直接跳到下一个工作日的目标时间，非工作日不再唤醒
+        return self.workday_calendar.next_workday_at(custom_time, now.tzinfo, now)
 
-    async def scheduled_task(self):
+    def reschedule(self):
+        '''日程发生变化，唤醒 scheduled_task 重新计算目标时间'''
+        self._schedule_changed.set()
+
+    def _rebuild_schedule(self):
+        '''
+        根据当前订阅重建调度堆，发送时间和时区相同的订阅归为一组。
+        优先使用订阅中保存的 next_due 快照，无需重新计算工作日。
+        启动后第一次重建时，补发停机期间错过且仍在补发窗口内的定时发送；
+        之后定时任务被关闭期间错过的发送不会补发
+        '''
+        self._schedule_heap.clear()
+        self._buckets.clear()
+        self._groups.clear()
+        self.next_target_time = None
+        catch_up, self._first_rebuild = self._first_rebuild, False
         if not self.enabled:
-            logger.info("定时任务未启用，跳过执行。")
+            self._catch_up.clear()
             return
-        logger.info(f"定时任务开始执行，任务时间: {self.user_custom_time}")
-        self.next_target_time = None
-        # 初始化计数器
-        check_count = 0
-        # 添加标志位，记录任务是否已经执行
-        task_executed = False
+        for umo, sub in self.subscriptions.items():
+            self._groups.setdefault((sub['time'], sub.get('timezone')), []).append(umo)
+        now = time.time()
+        for key, umos in self._groups.items():
+            if catch_up:
+                for umo in umos:
+                    missed = self._missed_due(key, self.subscriptions[umo], now)
+                    if missed is not None:
+                        self._catch_up.setdefault(missed, []).append(umo)
+            due = self._snapshot_due(key, umos)
+            if due is not None and due >= now:
+                self._add_to_bucket(key, due)
+            else:
+                self._schedule_group(key, now)
+        # 之后的重建保留尚未执行的补发批次
+        for due, umos in self._catch_up.items():
+            target_time = datetime.datetime.fromtimestamp(due, self.user_custom_timezone)
+            if catch_up:
+                logger.info(f"{len(umos)} 个会话错过了 {target_time} 的定时发送，准备补发")
+            self._push_target(due, target_time)
+        if self.next_target_time:
+            logger.info(f"下一次发送摸鱼图片的目标时间: {self.next_target_time}，共 {len(self._buckets)} 个发送批次")
+
+    def _snapshot_due(self, key, umos):
+        '''
+        一组订阅保存的下一次发送时间戳。各订阅不一致、与当前设置的时间不符，
+        或那天已不是工作日（覆盖文件或节假日数据有更新）时返回 None
+        '''
+        dues = {self.subscriptions[umo].get('next_due') for umo in umos}
+        if len(dues) != 1:
+            return None
+        due = dues.pop()
+        if due is None or not self._due_matches(key, due):
+            return None
+        return due
+
+    def _due_matches(self, key, due):
+        '''due（时间戳）是否仍是这组订阅的发送时刻：当地时间与设置的时间一致，且那天是工作日'''
+        custom_time, timezone = key
+        local = datetime.datetime.fromtimestamp(due, self._timezone(timezone))
+        return local.strftime("%H:%M") == custom_time and self.workday_calendar.is_workday(local.date())
+
+    def _missed_due(self, key, sub, now):
+        '''
+        订阅错过且仍在补发窗口内的发送时间戳：已触发但重启前尚未送达的 pending_due，
+        或重启前还没来得及触发的 next_due；该次已送达（last_sent 不早于它）时不算错过
+        '''
+        for due in (sub.get('pending_due'), sub.get('next_due')):
+            if due is not None and now - self.catch_up_seconds <= due < now \
+                    and sub.get('last_sent', 0) < due and self._due_matches(key, due):
+                return due
+        return None
+
+    def _schedule_group(self, key, after):
+        '''计算一组订阅在 after（时间戳）之后的下一个发送时刻，并归入该时刻的发送批次'''
+        custom_time, timezone = key
+        now = datetime.datetime.fromtimestamp(after, self._timezone(timezone))
+        target_time = self.get_next_target_time(now, custom_time)
+        if target_time is None:
+            return
+        self._add_to_bucket(key, target_time.timestamp())
+
+    def _add_to_bucket(self, key, due):
+        '''将一组订阅归入 due（时间戳）的发送批次，并把发送时间快照保存到订阅中'''
+        bucket = self._buckets.get(due)
+        if bucket is None:
+            bucket = self._buckets[due] = set()
+            self._push_target(due, datetime.datetime.fromtimestamp(due, self.user_custom_timezone))
+        bucket.add(key)
+        changed = []
+        for umo in self._groups[key]:
+            # 发送期间订阅可能已被 /reset_time 删除，_groups 要到下次重建才更新
+            sub = self.subscriptions.get(umo)
+            if sub is not None and sub.get('next_due') != due:
+                sub['next_due'] = due
+                changed.append(umo)
+        if changed:
+            self.save_schedule(changed)
+
+    def _push_target(self, due, target_time):
+        '''将发送时刻及其预取时间加入调度堆'''
+        heapq.heappush(self._schedule_heap, (due, next(self._schedule_seq), "send", target_time))
+        if self.next_target_time is None or target_time < self.next_target_time:
+            self.next_target_time = target_time
+        if self.prefetch_seconds <= 0:
+            return
+        # 预取时间不早于当前时间，且与目标时间在同一天，避免缓存到前一天的图片
+        now = datetime.datetime.now(target_time.tzinfo)
+        warm_time = max(target_time - datetime.timedelta(seconds=self.prefetch_seconds), now)
+        if warm_time < target_time and warm_time.date() == target_time.date():
+            heapq.heappush(self._schedule_heap, (warm_time.timestamp(), next(self._schedule_seq), "warm", target_time))
+
+    def _spawn(self, coro):
+        '''启动后台任务并保存引用，插件卸载时统一取消'''
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def _warm_up(self, target_time):
+        '''在目标时间前预取并缓存图片，到目标时间会过期的缓存也提前再验证，失败时在预取窗口内重试'''
+        while True:
+            if await self.get_moyu_image(fresh_until=target_time.timestamp()):
+                logger.info(f"已预取 {target_time} 发送的摸鱼图片")
+                return
+            remaining = (target_time - datetime.datetime.now(target_time.tzinfo)).total_seconds()
+            if remaining <= self.prefetch_retry_interval:
+                logger.error(f"预取 {target_time} 发送的摸鱼图片失败，将在发送时重新获取")
+                return
+            await asyncio.sleep(self.prefetch_retry_interval)
+
+    async def scheduled_task(self):
+        '''
+        定时任务主循环：精确睡眠到堆顶的到期时间，
+        set_time、reset_time、set_timezone、timed_tasks 修改日程后立即唤醒重新调度
+        '''
+        self._rebuild_schedule()
         while True:
-            if not self.enabled:
-                await asyncio.sleep(60)
-                continue
             try:
-                if not self.user_custom_time or not self.message_target:
-                    check_count += 1
-                    if check_count >= 3:
-                        # 不退出循环，而是继续等待
-                        await asyncio.sleep(60)
-                        continue
-                    await asyncio.sleep(60)
+                # 先处理日程变化，保证到期批次使用的是最新的订阅
+                if self._schedule_changed.is_set():
+                    self._schedule_changed.clear()
+                    self._rebuild_schedule()
+                if self._schedule_heap:
+                    # 单次最多睡眠一小时，防止系统时间被调整后长时间偏离
+                    delay = min(self._schedule_heap[0][0] - time.time(), 3600)
+                else:
+                    delay = None
+                if delay is None or delay > 0:
+                    try:
+                        await asyncio.wait_for(self._schedule_changed.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
                     continue
 
-                # 获取当前时间，使用用户自定义的时区
-                now = datetime.datetime.now(self.user_custom_timezone)
-                logger.info(f"获取当前时间: {now}")
-
-
-                # 检查当前日期是否为工作日
-                is_workday = calendar.is_workday(now.date())
-                if is_workday:
-                    logger.info(f"当前日期 {now.date()} 是工作日，继续执行定时任务。")
-                if not is_workday:
-                    logger.info(f"当前日期 {now.date()} 不是工作日，等待到下一天午夜继续检查。")
-                    # 如果不是工作日，计算到下一天午夜的时间差
-                    next_day = now + datetime.timedelta(days=1)
-                    next_day_midnight = next_day.replace(hour=0, minute=0, second=0, microsecond=0)
-                    time_until_next_day = (next_day_midnight - now).total_seconds()
-                    logger.info(f"距离下一天午夜还有 {int(time_until_next_day)} 秒，开始等待。")
-                    # 等待到下一天午夜再继续检查
-                    await asyncio.sleep(time_until_next_day)
+                due, _, kind, target_time = heapq.heappop(self._schedule_heap)
+                if kind == "warm":
+                    self._spawn(self._warm_up(target_time))
                     continue
-
-                # 如果下一次目标时间未设置或当前时间已经超过目标时间，重新计算下一次目标时间
-                if self.next_target_time is None or now > self.next_target_time:
-                    self.next_target_time = self.get_next_target_time(now)
-                # 计算当前时间距离下一次目标时间的秒数
-                time_until_target = (self.next_target_time - now).total_seconds()
-                
-
-                # 记录日志，显示距离下一次发送摸鱼图片的剩余时间
-                logger.info(f"距离下次发送摸鱼图片还剩 {time_until_target} 秒")
-
-                # 当剩余时间大于 60 秒时，每次等待 60 秒
-                while time_until_target > 60:
-                    if not self.enabled:
-                        logger.info("定时任务已禁用，跳出等待循环。")
-                        break
-                    await asyncio.sleep(60)
-                    # 更新当前时间
-                    now = datetime.datetime.now(self.user_custom_timezone)
-                    # 检查 self.next_target_time 是否为 None
-                    if self.next_target_time is None:
-                        self.next_target_time = self.get_next_target_time(now)
-                        if self.next_target_time is None:
-                            logger.error("无法计算下一次目标时间，等待一段时间后重试。")
-                            await asyncio.sleep(60)
-                            continue
-                    # 重新计算剩余时间
-                    time_until_target = (self.next_target_time - now).total_seconds()
-
-                # 当剩余时间小于等于 100 秒时，等待剩余时间
-                if time_until_target <= 100 and self.enabled:
-                    logger.info(f"等待 {time_until_target} 秒")
-                    await asyncio.sleep(time_until_target)
-                    # 等待结束后，再次检查是否到了执行任务的时间
-                    now = datetime.datetime.now(self.user_custom_timezone)
-                    # 添加工作日验证
-                    is_workday = calendar.is_workday(now.date())
-                    if is_workday:
-                        if now >= self.next_target_time:
-                            logger.info("已到达目标时间，准备执行任务")
-                        # 重置 task_executed 标志位
-                        task_executed = False
+                self.next_target_time = min((entry[3] for entry in self._schedule_heap if entry[2] == "send"), default=None)
+                keys = self._buckets.pop(due, set())
+                missed = self._catch_up.pop(due, [])
+                umos = [umo for key in keys for umo in self._groups.get(key, [])] + missed
+                # 跳过本次已经发送过的会话（例如重启前已发送、重启后补发时）
+                targets = [
+                    (umo, self._timezone(self.subscriptions[umo].get('timezone')))
+                    for umo in umos
+                    if umo in self.subscriptions and self.subscriptions[umo].get('last_sent', 0) < due
+                ]
+                # 记录已触发但尚未送达的发送时间，全部送达前重启时据此补发
+                for umo, _ in targets:
+                    self.subscriptions[umo]['pending_due'] = due
+                if targets:
+                    self.save_schedule([umo for umo, _ in targets])
+                now = datetime.datetime.now(self.user_custom_timezone)
+                if targets:
+                    drift = (now - target_time).total_seconds()
+                    if missed:
+                        # 补发的延迟取决于停机时长，单独计数，不计入调度偏差
+                        self.metrics.inc("moyu_scheduler_catch_up_total", len(targets))
+                        logger.info(f"补发 {target_time} 的定时发送，延迟 {drift:.3f} 秒，共 {len(targets)} 个发送目标")
                     else:
-                        logger.info(f"当前日期 {now.date()} 不是工作日，跳过本次任务执行。")
-
-                
-                if not task_executed:
-                    # 获取摸鱼图片的本地路径
-                    image_path = await self.get_moyu_image()
-                    if image_path:
-                        # 获取当前时间的字符串表示
-                        current_time = now.strftime("%Y-%m-%d %H:%M")
-                        # 创建消息链，包含摸鱼日历标题、当前时间、图片和摸鱼提醒
-                        message_chain = MessageChain([
-                            Plain("📅 摸鱼人日历"),
-                            Plain(f"🎯 {current_time}"),
-                            Image.fromFileSystem(image_path),  # 使用 fromFileSystem 方法
-                            Plain("⏰ 摸鱼提醒：工作再累，一定不要忘记摸鱼哦 ~")
-                        ])
-                        # 发送失败重试机制
-                        max_retries = 3
-                        for retry in range(max_retries):
-                            try:
-                                # 发送消息链到指定的消息目标
-                                await self.context.send_message(self.message_target, message_chain)
-                                logger.info("摸鱼图片发送成功。")
-                                # 标记任务已执行
-                                task_executed = True
-                                break
-                            except Exception as e:
-                                if retry < max_retries - 1:
-                                    logger.error(f"发送消息失败，第 {retry + 1} 次重试: {str(e)}")
-                                    await asyncio.sleep(5)  # 等待 5 秒后重试
-                                else:
-                                    logger.error(f"定时发送消息失败: {str(e)}")
-                                    # 即使发送失败，也标记任务已执行
-                                    task_executed = True
-
-                # 计算下一次目标时间
-                self.next_target_time = self.get_next_target_time(now)
-                logger.info(f"计算下一次目标时间: {self.next_target_time}")
+                        self.metrics.observe("moyu_scheduler_drift_seconds", max(drift, 0.0), buckets=Metrics.DRIFT_BUCKETS)
+                        logger.info(f"已到达目标时间 {target_time}，偏差 {drift:.3f} 秒，共 {len(targets)} 个发送目标")
+                    await self.send_scheduled(targets, now, due=due)
+                # 计算各组的下一次目标时间，至少越过本次目标时间，避免同一分钟重复发送
+                after = max(time.time(), due + 1)
+                for key in keys:
+                    if key in self._groups:
+                        self._schedule_group(key, after)
+                logger.info(f"下一次发送摸鱼图片的目标时间: {self.next_target_time}")
 
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 # 记录定时任务出错的错误日志
-                logger.error(f"定时任务出错: {str(e)}")
-                # 记录错误详情
-                logger.error(f"错误详情: {e.__class__.__name__}")
-                import traceback
-                # 记录错误堆栈信息
+                logger.error(f"定时任务出错: {e.__class__.__name__}: {str(e)}")
                 logger.error(f"堆栈信息: {traceback.format_exc()}")
-                # 初始化错误重试计数器
-                error_retry_count = 0
-                # 设置最大重试次数
-                max_retry_count = 3
-                while error_retry_count < max_retry_count:
-                    # 出错后等待 60 秒再重试
-                    logger.info(f"定时任务出错，第 {error_retry_count + 1} 次重试，等待 60 秒")
-                    await asyncio.sleep(60)
-                    error_retry_count += 1
-                    try:
-                        # 尝试重新执行任务逻辑
-                        if not self.user_custom_time or not self.message_target:
-                            check_count += 1
-                            if check_count >= 3:
-                                logger.error("检查设置次数达到上限，暂停检查，等待设置更新。")
-                                continue
-                            continue
-                        break  # 如果成功执行，跳出重试循环
-                    except Exception as e:
-                        logger.error(f"第 {error_retry_count} 次重试失败: {str(e)}")
-                if error_retry_count == max_retry_count:
-                    logger.error("达到最大重试次数，暂停任务，等待设置更新。")
-         
+                # 出错后等待 60 秒或日程更新后重新调度
+                try:
+                    await asyncio.wait_for(self._schedule_changed.wait(), timeout=60)
+                except asyncio.TimeoutError:
+                    pass
+                self._schedule_changed.set()
 
+    async def send_scheduled(self, targets, now, due=None):
+        '''
+        向一批订阅目标发送定时摸鱼图片，整批只获取一次图片。
+        targets 为 (unified_msg_origin, 时区) 列表，消息中的时间按各自的时区显示，
+        due 为计划发送的时间戳，用于统计实际送达相对计划时间的延迟
+        '''
+        # 获取摸鱼图片的本地路径
+        image_path = await self.get_moyu_image()
+        if not image_path:
+            logger.error("获取摸鱼图片失败，跳过本次定时发送。")
+            return
+        # 每个平台使用各自规格的图片，整批每个平台只编码一次
+        variants = await self.get_image_variants(image_path, {umo.split(':', 1)[0] for umo, _ in targets})
+        # 获取当前时间的字符串表示，同一时区只格式化一次
+        current_times = {}
+        for umo, tz in targets:
+            if tz not in current_times:
+                current_times[tz] = now.astimezone(tz).strftime("%Y-%m-%d %H:%M")
+            self.enqueue_delivery(umo, variants[umo.split(':', 1)[0]], current_times[tz], due)
+        logger.info(f"已将 {len(targets)} 个发送目标加入发送队列。")
+
+    def build_message_chain(self, image_path, current_time):
+        '''创建消息链，包含摸鱼日历标题、当前时间、图片和摸鱼提醒'''
+        return MessageChain([
+            Plain("📅 摸鱼人日历"),
+            Plain(f"🎯 {current_time}"),
+            Image.fromFileSystem(image_path),  # 使用 fromFileSystem 方法
+            Plain("⏰ 摸鱼提醒：工作再累，一定不要忘记摸鱼哦 ~")
+        ])
+
+    def enqueue_delivery(self, target, image_path, current_time, due=None):
+        '''将一条摸鱼图片消息加入发送队列，due 为定时发送的计划时间戳'''
+        # 按并发数启动发送协程，插件卸载时随后台任务一起取消
+        while len(self._delivery_workers) < self.send_concurrency:
+            self._delivery_workers.append(self._spawn(self._delivery_worker()))
+        self._delivery_queue.put_nowait({
+            'id': uuid.uuid4().hex[:8],
+            'target': target,
+            'image_path': image_path,
+            'sent_time': current_time,
+            'attempts': 0,
+            'due': due,
+        })
+
+    async def _delivery_worker(self):
+        while True:
+            job = await self._delivery_queue.get()
+            self._delivering[job['id']] = job
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"发送队列处理出错: {e.__class__.__name__}: {str(e)}")
+            finally:
+                self._delivering.pop(job['id'], None)
+                self._delivery_queue.task_done()
+
+    def _requeue(self, job):
+        self._retry_jobs.pop(job['id'], None)
+        self._delivery_queue.put_nowait(job)
+
+    def _dead_letter_pending_deliveries(self):
+        '''将发送中、排队中和等待重试的消息写入死信记录，可在重新加载后用 /moyu_replay 重新发送'''
+        jobs = list(self._delivering.values())
+        while not self._delivery_queue.empty():
+            jobs.append(self._delivery_queue.get_nowait())
+        for handle, job in self._retry_jobs.values():
+            handle.cancel()
+            jobs.append(job)
+        self._delivering.clear()
+        self._retry_jobs.clear()
+        if not jobs:
+            return
+        for job in jobs:
+            job['error'] = job.get('error') or "插件卸载时尚未发送"
+            self._add_dead_letter(job)
+        logger.error(f"插件卸载时还有 {len(jobs)} 条消息未发送，已写入死信记录")
+
+    def _parse_rate_limits(self, items):
+        '''解析 "平台名=速率/突发" 格式的平台限速配置，例如 aiocqhttp=2/5'''
+        limits = {}
+        for item in items:
+            try:
+                platform, limit = item.split('=', 1)
+                rate, _, burst = limit.partition('/')
+                limits[platform.strip()] = (float(rate), max(1, int(burst or 1)))
+            except ValueError:
+                logger.error(f"平台限速配置格式错误: {item}，应为 平台名=速率/突发，例如 aiocqhttp=2/5")
+        return limits
+
+    def _platform_bucket(self, target):
+        # unified_msg_origin 的格式为 平台名:消息类型:会话ID
+        platform = target.split(':', 1)[0]
+        bucket = self._platform_buckets.get(platform)
+        if bucket is None:
+            rate, burst = self.platform_rate_overrides.get(platform, (self.platform_rate, self.platform_burst))
+            bucket = TokenBucket(rate, burst) if rate > 0 else None
+            self._platform_buckets[platform] = bucket
+        return bucket
+
+    def _target_bucket(self, target):
+        if self.target_rate <= 0:
+            return None
+        bucket = self._target_buckets.get(target)
+        if bucket is None:
+            if len(self._target_buckets) >= 10000:
+                # 清理已补满令牌的会话，防止长期运行后占用过多内存
+                self._target_buckets = {k: v for k, v in self._target_buckets.items() if not v.idle()}
+            bucket = self._target_buckets[target] = TokenBucket(self.target_rate, self.target_burst)
+        return bucket
+
+    async def _wait_rate_limit(self, target):
+        '''依次等待会话和平台的令牌，先等会话令牌以免占着平台令牌空等'''
+        for bucket in (self._target_bucket(target), self._platform_bucket(target)):
+            if bucket is not None:
+                await bucket.acquire()
+
+    async def _deliver(self, job):
+        '''发送一条消息，失败时按指数退避加随机抖动重新入队，达到上限后写入死信记录'''
+        sub = self.subscriptions.get(job['target'])
+        if job.get('due') and sub is not None and sub.get('last_sent', 0) >= job['due']:
+            # 该次定时发送已经送达（例如重启后已补发，又从死信记录重新发送）
+            logger.info(f"{job['target']} 已收到该次定时发送的消息，跳过")
+            return
+        await self._wait_rate_limit(job['target'])
+        platform = job['target'].split(':', 1)[0]
+        start = time.monotonic()
+        try:
+            # 发送消息链到指定的消息目标，没有与会话匹配的平台时 send_message 返回 False
+            if await self.context.send_message(job['target'], self.build_message_chain(job['image_path'], job['sent_time'])) is False:
+                raise RuntimeError(f"未找到会话 {job['target']} 对应的平台")
+            self.metrics.observe("moyu_send_seconds", time.monotonic() - start, platform=platform)
+            self.metrics.inc("moyu_sends_total", platform=platform)
+            if job.get('due'):
+                # 定时发送实际送达时间相对计划时间的延迟，包含排队、限速和重试
+                self.metrics.observe("moyu_delivery_delay_seconds", max(time.time() - job['due'], 0.0))
+                # 记录已发送，重启后补发时据此避免重复发送
+                sub = self.subscriptions.get(job['target'])
+                if sub is not None and sub.get('last_sent', 0) < job['due']:
+                    sub['last_sent'] = job['due']
+                    if sub.get('pending_due', 0) <= job['due']:
+                        sub.pop('pending_due', None)
+                    self.save_schedule([job['target']])
+            return
+        except Exception as e:
+            job['attempts'] += 1
+            job['error'] = f"{e.__class__.__name__}: {str(e)}"
+            self.metrics.inc("moyu_send_failures_total", platform=platform)
+            self.target_failures[job['target']] += 1
+        if job['attempts'] >= self.send_max_retries:
+            self.metrics.inc("moyu_dead_letters_total", platform=platform)
+            logger.error(f"向 {job['target']} 发送消息失败，已重试 {job['attempts']} 次，写入死信记录: {job['error']}")
+            self._add_dead_letter(job)
+            return
+        delay = min(self.send_retry_base * 2 ** (job['attempts'] - 1), self.send_retry_max)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        logger.error(f"向 {job['target']} 发送消息失败，{delay:.1f} 秒后第 {job['attempts']} 次重试: {job['error']}")
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, job)
+        self._retry_jobs[job['id']] = (handle, job)
+
+    def _load_dead_letters(self):
+        if not os.path.exists(self.dead_letter_file):
+            return []
+        try:
+            with open(self.dead_letter_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"加载死信记录失败: {e}")
+            return []
 
+    def _save_dead_letters(self):
+        self._dead_letter_writer.save(self.dead_letters)
 
+    def _add_dead_letter(self, job):
+        job['failed_at'] = datetime.datetime.now(self.user_custom_timezone).strftime("%Y-%m-%d %H:%M:%S")
+        self.dead_letters.append(job)
+        # 只保留最近的死信记录
+        del self.dead_letters[:-self.dead_letter_limit]
+        self._save_dead_letters()